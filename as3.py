@@ -22,10 +22,66 @@ To Do:
 ###############################################################################
 import os
 import sys
+import shutil
 import time
 import json
+import copy
+import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 import iCR
+# Use orjson to parse Github responses when it is installed
+try:
+  import orjson
+  _loads = orjson.loads
+except ImportError:
+  _loads = json.loads
+
+# Number of seconds the Github releases list is cached for
+RELEASES_CACHE_TTL = 300
+# Number of seconds to wait for a package install or uninstall to complete
+TASK_TIMEOUT = 30
+# Number of seconds isInstalled(use_cache=True) trusts the last checked result for
+INSTALLED_CACHE_TTL = 2
+# Assets larger than this are downloaded as PARALLEL_CHUNKS concurrent byte ranges
+PARALLEL_MIN_SIZE = 8 * 1024 * 1024
+PARALLEL_CHUNKS = 4
+# Thread pool for small disk writes which can overlap with network transfers
+_IO_POOL = ThreadPoolExecutor(max_workers=2)
+
+# Matches a hex encoded SHA-256 digest
+_SHA256_RE = re.compile(r'\b([0-9a-fA-F]{64})\b')
+
+def _sha256_file(path):
+  # Return the hex SHA-256 digest of the file at path
+  with open(path,'rb') as fd:
+    if hasattr(hashlib, 'file_digest'):
+      return hashlib.file_digest(fd, 'sha256').hexdigest()
+    digest = hashlib.sha256()
+    buf = bytearray(1024*1024)
+    view = memoryview(buf)
+    size = fd.readinto(buf)
+    while size:
+      digest.update(view[:size])
+      size = fd.readinto(buf)
+    return digest.hexdigest()
+
+def _write_notes(name,body):
+  # Write the release notes for release name to release-notes-<name>.txt, replacing it atomically
+  filename = 'release-notes-' + name + '.txt'
+  tmp = filename + '.tmp'
+  try:
+    with open(tmp,'w',encoding='utf-8',errors='replace') as fd:
+      fd.write(body)
+    os.replace(tmp, filename)
+  except BaseException:
+    if os.path.exists(tmp):
+      os.unlink(tmp)
+    raise
 
 class as3:
    
@@ -43,6 +99,37 @@ class as3:
     # self.bigip is the iCR object with which to connect to the BIG-IP
     self.bigip = False
     self.error = ''
+    # self._gh is the requests session used for all Github API calls so connections are reused
+    self._gh = requests.Session()
+    self._gh.headers.update({ 'User-Agent': 'as3', 'Content-Type': 'application/json' })
+    # Small connection pool and retries on transient Github errors
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429,500,502,503,504])
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry)
+    self._gh.mount('https://', adapter)
+    # self._releases_cache is (timestamp, { name: release dict }) of the Github releases list
+    self._releases_cache = (0, None)
+    # ETag and body of the last /mgmt/shared/appsvcs/info response so unchanged info returns 304
+    self._info_etag = None
+    self._info_cached = None
+    # Result and time of the last isInstalled check
+    self._installed_version = None
+    self._installed_check_ts = 0
+    # self._icr_cache holds password authenticated iCR objects keyed by (host, username, port) so connections are reused
+    self._icr_cache = {}
+
+  def close(self):
+    """
+    Description
+    -----------
+    This method closes the Github session and releases any pooled connections
+
+    Parameters
+    ----------
+    None
+
+    Return: none
+    """
+    self._gh.close()
   
   def _debug(self,msg):
     """
@@ -62,7 +149,7 @@ class as3:
     if self.debug:
       print("DEBUG: " + msg)
   
-  def bigipConnect(self,**kwargs):
+  def bigipConnect(self,*,host=None,username=None,password=None,usetoken=False,port=None):
     """
     Description
     -----------
@@ -82,11 +169,18 @@ class as3:
 
     Return: True on success, False on failure. Sets self.bigip to be the bigip link.
     """
-    host = kwargs.pop('host',self.host)
-    username = kwargs.pop('username',self.username)
-    password = kwargs.pop('password',self.password)
-    usetoken = kwargs.pop('usetoken',False)
-    port = kwargs.pop('port',self.port)
+    host = host or self.host
+    username = username or self.username
+    password = password or self.password
+    port = port or self.port
+    # Reuse an existing connection to the same BIG-IP with the same credentials. Token connections are
+    # not reused as BIG-IP tokens expire and calling bigipConnect is how a fresh token is retrieved
+    key = (host, username, str(port))
+    cached = self._icr_cache.get(key)
+    if not usetoken and cached and cached.password == password:
+      self._debug("Reusing BIG-IP connection to " + host)
+      self._set_bigip(cached)
+      return True
     # Create the icr connection to the BIG-IP
     bigip = iCR.iCR(host,username,password,port=port,debug=self.debug)
 
@@ -99,7 +193,7 @@ class as3:
         self.error = "Cannot retrieve token from host " + host + " with username " + username
         return False
       else:
-        self.bigip = bigip
+        self._set_bigip(bigip)
         return True
     if not bigip:
       self.error = bigip.error
@@ -107,10 +201,18 @@ class as3:
       return False
     else:
       self._debug("BIG-IP connection success")
-      self.bigip = bigip
+      self._icr_cache[key] = bigip
+      self._set_bigip(bigip)
       return True
+
+  def _set_bigip(self,bigip):
+    # Switch self.bigip to the iCR object bigip, dropping cached state from any previous BIG-IP
+    if self.bigip is not bigip:
+      self.bigip = bigip
+      self._info_etag = None
+      self._installed_check_ts = 0
   
-  def github(self,url,**kwargs):
+  def github(self,url,*,method='get',data=None,useragent='as3',stream=False,as_json=False):
     """
     Description
     -----------
@@ -125,17 +227,18 @@ class as3:
     method : string. Default is GET, this allows setting of POST instead, which then requires the data keyword below
     data : dict. Dictionary representing the sent data eg { "name": "myName" }
     useragent : string. The user agent to be used. Default as3
-    stream : Boolean, If set to true, the Accept header is set to retrieve stream data
+    stream : Boolean, If set to true, the Accept header is set to retrieve stream data and the response object is returned
+    as_json : Boolean, If set to true, the response is returned already parsed from JSON
 
-    Returns Boolean True or False
+    Returns the response text, the parsed JSON, the streamed response object or False on failure
     """
 
-    method = kwargs.pop('method','get')
-    data = kwargs.pop('data',{})
-    useragent = kwargs.pop('useragent','as3')
-    stream = kwargs.pop('stream',False)
-    # Setup requests settings
-    headers = { 'User-Agent': useragent , 'Content-Type': 'application/json' }
+    if data is None:
+      data = {}
+    # Setup per-request headers, the session holds the defaults
+    headers = {}
+    if useragent != 'as3':
+      headers['User-Agent'] = useragent
     if stream:
       headers['Accept'] = 'application/octet-stream'
 
@@ -144,13 +247,11 @@ class as3:
 
     try:
       if method == 'post':
-        # Convert the data to JSON
-        dataJson = json.dumps(data)
-        response = requests.post(uri, data=dataJson, headers=headers, timeout=10)
+        response = self._gh.post(uri, json=data, headers=headers, timeout=10)
       else:
-        response = requests.get(uri, headers=headers, timeout=10)
-    except Exception as e:
-      self.error = e
+        response = self._gh.get(uri, headers=headers, stream=stream, timeout=10)
+    except requests.exceptions.RequestException as e:
+      self.error = str(e)
       return False
     self._debug("github: Response code " + str(response.status_code))
     if response.status_code != 200:
@@ -158,25 +259,23 @@ class as3:
       return False
     else:
       if stream:
-        # Return an iterable object
-        return response.iter_content(chunk_size=1024)
+        # Return the response so the caller can read directly from response.raw
+        return response
+      elif as_json:
+        return _loads(response.content)
       else:
         return response.text
     
-  def installAS3(self,**kwargs):
+  def installAS3(self,*,version=False,filename=False,host=None,username=None,password=None,usetoken=False,port=None):
     # Allow the user to specify access details, otherwise inherit from the object
-    version = kwargs.pop('version',False)
-    filename = kwargs.pop('filename',False)
-    #
-    host = kwargs.pop('host',self.host)
-    username = kwargs.pop('username',self.username)
-    password = kwargs.pop('password',self.password)
-    usetoken = kwargs.pop('usetoken',False)
-    port = kwargs.pop('port',self.port)
+    host = host or self.host
+    username = username or self.username
+    password = password or self.password
+    port = port or self.port
 
     # Connect to the BIG-IP if not already done so
     if not self.bigip:
-      if not self.bigipConnect(host=host,username=username,password=password,port=port,usetoken=usetoken,debug=self.debug):
+      if not self.bigipConnect(host=host,username=username,password=password,port=port,usetoken=usetoken):
         return False
 
     # Perform touch on file to enable iApps LX
@@ -184,26 +283,12 @@ class as3:
       self.error = "Cannot perform touch on /var/config/rest/iapps/enable"
       return False
     
-    # If a filename has been specified then use that
+    # If a filename has been specified then use that, otherwise download it from Github
     if filename:
       self._debug("Filename " + filename + " specified, uploading to host " + host)
-    elif version:
-      # If a version name has been specified then download and use that
-      vid = self.versionToId(version)
-      if not vid:
-        self.error = "Cannot retrieve ID for version " + version + " error: " + str(self.error)
-        return False
-      filename = self.retrieveVersion(release=vid) 
-      if not filename:
-        self.error = "Cannot retrieve version " + version + " error: " + str(self.error)
-        return False
     else:
-      # Otherwise download and install the latest version
-      filename = self.retrieveVersion()
-      # ToDo: Return the version so it can be checked whether it is installed
-      # Download failed
+      filename = self._fetch_rpm(version)
       if not filename:
-        self.error = "Cannot retrieve latest version, error: " + str(self.error)
         return False
     # At this point, filename is the name of the local RPM file to upload to the BIG-IP
     # Check that it actually exists
@@ -213,46 +298,139 @@ class as3:
     self._debug("Uploading file " + filename)
     if not self.bigip.upload(filename):
       self.error = "Upload of file " + filename + " to host " + host + " failed. " + self.bigip.error
+      return False
     elif self.debug:
       print ("File " + filename + " successfully uploaded to host " + host)
     
     # Install from /var/config/rest/downloads/
     self._debug("Installing package " + filename + " from /var/config/rest/downloads")
     
-    data = json.dumps({  "operation": "INSTALL", 
+    # iCR.create accepts a dict and encodes it itself
+    data = {  "operation": "INSTALL", 
               "packageFilePath": "/var/config/rest/downloads/" + filename
-            })
-    self.bigip.create('/mgmt/shared/iapp/package-management-tasks',data)
+            }
+    task = self.bigip.create('/mgmt/shared/iapp/package-management-tasks',data)
     if self.bigip.code != 202:
       self.error = "request to perform install task for " + filename + " failed: " + self.bigip.error
       return False
     else:
       self._debug("Created task to install package " + filename)
-    self._debug("Waiting for 5 secs")
-    time.sleep(5)
+    deadline = time.monotonic() + TASK_TIMEOUT
+    if not self._wait_task(task['id'],timeout=deadline - time.monotonic()):
+      self.error = "Install task for " + filename + " failed: " + str(self.error)
+      return False
 
-    # Check the package has actually been installed successfully
+    # Check the package has actually been installed successfully. The BIG-IP reloads the extension
+    # after the task finishes and /mgmt/shared/appsvcs/info returns 404 until then, so poll it
     self._debug("Checking whether the package is installed")
-    installed = self.isInstalled(host=host,username=username,password=password,usetoken=usetoken,port=port,debug=self.debug)
+    installed = self._poll(lambda: self.isInstalled(host=host,username=username,password=password,usetoken=usetoken,port=port) or None,
+                           deadline - time.monotonic())
     if not installed:
       self.error = "Package " + filename + " not installed successfully"
       return False
     else:
       self._debug("Package " + filename + " installed successfully")
       return True
-  def uninstallAS3(self,**kwargs):
+
+  def _fetch_rpm(self,version):
+    """
+    Description
+    -----------
+    This method downloads the RPM for a version name, or the latest version, from Github
+
+    Parameters
+    ----------
+    version : string. The release name eg 'v3.16.0', or False for the latest version
+
+    Return: the filename of the downloaded RPM on success, False on failure. Sets self.error on failure.
+    """
+    if version:
+      # If a version name has been specified then download and use that
+      release = self._find_release(version)
+      if not release:
+        self.error = "Cannot retrieve ID for version " + version + " error: " + str(self.error)
+        return False
+      filename = self.retrieveVersion(release_obj=release)
+      if not filename:
+        self.error = "Cannot retrieve version " + version + " error: " + str(self.error)
+        return False
+    else:
+      # Otherwise download and install the latest version
+      filename = self.retrieveVersion()
+      # ToDo: Return the version so it can be checked whether it is installed
+      # Download failed
+      if not filename:
+        self.error = "Cannot retrieve latest version, error: " + str(self.error)
+        return False
+    return filename
+
+  def _poll(self,check,timeout):
+    """
+    Description
+    -----------
+    This method calls check repeatedly, backing off from 0.1 to 2 seconds between calls, until it returns
+    something other than None or timeout seconds have passed
+
+    Parameters
+    ----------
+    check : function. Takes no arguments and returns None to keep waiting
+    timeout : number. The number of seconds to wait before giving up
+
+    Return: the first result of check which is not None, or None on timeout
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while True:
+      result = check()
+      if result is not None:
+        return result
+      if time.monotonic() + delay > deadline:
+        return None
+      time.sleep(delay)
+      delay = min(delay * 2, 2.0)
+
+  def _wait_task(self,task_id,timeout=TASK_TIMEOUT):
+    """
+    Description
+    -----------
+    This method polls a package management task until it completes
+
+    Parameters
+    ----------
+    task_id : string. The ID of the task returned when it was created
+    timeout : number. The number of seconds to wait before giving up. Default TASK_TIMEOUT
+
+    Return: True if the task finished, False if it failed or timed out. Sets self.error on failure.
+    """
+    uri = '/mgmt/shared/iapp/package-management-tasks/' + str(task_id)
+    def check():
+      task = self.bigip.get(uri)
+      status = task.get('status') if task else None
+      self._debug("Task " + str(task_id) + " status: " + str(status))
+      if status == 'FINISHED':
+        return True
+      if status == 'FAILED':
+        self.error = "Task " + str(task_id) + " failed: " + str(task.get('errorMessage',''))
+        return False
+      return None
+    result = self._poll(check, timeout)
+    if result is None:
+      self.error = "Timed out waiting for task " + str(task_id)
+      return False
+    return result
+
+  def uninstallAS3(self,*,host=None,username=None,password=None,usetoken=False,port=None):
     # https://clouddocs.f5.com/products/extensions/f5-appsvcs-extension/latest/userguide/installation.html#uninstalling-as3
     # Allow the user to specify access details, otherwise inherit from the object
     #
-    host = kwargs.pop('host',self.host)
-    username = kwargs.pop('username',self.username)
-    password = kwargs.pop('password',self.password)
-    usetoken = kwargs.pop('usetoken',False)
-    port = kwargs.pop('port',self.port)
+    host = host or self.host
+    username = username or self.username
+    password = password or self.password
+    port = port or self.port
 
     # Connect to the BIG-IP if not already done so
     if not self.bigip:
-      if not self.bigipConnect(host=host,username=username,password=password,port=port,usetoken=usetoken,debug=self.debug):
+      if not self.bigipConnect(host=host,username=username,password=password,port=port,usetoken=usetoken):
         return False
     # Retrieve the current version
     currentVersion = self.isInstalled(host=host,username=username,password=password,usetoken=usetoken,port=port)
@@ -271,101 +449,299 @@ class as3:
     if not response:
       self.error = "Error uninstalling package " + packageName
       return False
-    time.sleep(5)
-    # Confirm it has been removed
-    if not self.isInstalled(host=host,username=username,password=password,usetoken=usetoken,port=port):
+    deadline = time.monotonic() + TASK_TIMEOUT
+    if not self._wait_task(response['id'],timeout=deadline - time.monotonic()):
+      self.error = "Uninstall task for " + packageName + " failed: " + str(self.error)
+      return False
+    # Confirm it has been removed. The BIG-IP reloads after the task finishes and
+    # /mgmt/shared/appsvcs/info can report the old version until then, so poll it
+    removed = self._poll(lambda: None if self.isInstalled(host=host,username=username,password=password,usetoken=usetoken,port=port) else True,
+                         deadline - time.monotonic())
+    if removed:
       return True
     else:
-      self.error("Package seems to be uninstalled but cannot be confirmed")
+      self.error = "Package seems to be uninstalled but cannot be confirmed"
       return False
 
-  def isInstalled(self,**kwargs):
+  def isInstalled(self,*,version=False,host=None,username=None,password=None,usetoken=False,port=None,use_cache=False):
     # Function to check whether the appsvcs AS3 extension is installed
-    version = kwargs.pop('version',False)
-    #
-    host = kwargs.pop('host',self.host)
-    username = kwargs.pop('username',self.username)
-    password = kwargs.pop('password',self.password)
-    usetoken = kwargs.pop('usetoken',False)
-    port = kwargs.pop('port',self.port)
+    # use_cache => return the result of a check made in the last INSTALLED_CACHE_TTL seconds, eg straight after installAS3
+    if use_cache and not version and self._installed_check_ts and time.monotonic() - self._installed_check_ts < INSTALLED_CACHE_TTL:
+      self._debug("Using cached installed version")
+      return copy.deepcopy(self._installed_version)
+    host = host or self.host
+    username = username or self.username
+    password = password or self.password
+    port = port or self.port
     #
     # Connect to the BIG-IP if not already done so
     if not self.bigip:
-      if not self.bigipConnect(host=host,username=username,password=password,port=port,usetoken=usetoken,debug=self.debug):
+      if not self.bigipConnect(host=host,username=username,password=password,port=port,usetoken=usetoken):
         self._debug("Cannot connect to " + host)
         return False
-    response = self.bigip.get('/mgmt/shared/appsvcs/info')
+    response = self._get_info()
     if not response:
       self._debug("Response from /mgmt/shared/appsvcs/info False")
-      return False  
+      # Do not cache a failure, which may be transient, and drop any older result
+      self._installed_check_ts = 0
+      return False
+    self._debug("Response dict => " + str(response))
+    if 'version' in response:
+      installed = response
     else:
-      self._debug("Response dict => " + str(response))
-      if version and 'version' in response and response["version"] != version:
-          return False 
-      if 'version' in response:
-        return response
-      else:
-        return True
+      installed = True
+    self._installed_version = copy.deepcopy(installed)
+    self._installed_check_ts = time.monotonic()
+    if version and installed is not True and installed["version"] != version:
+      return False
+    return installed
+
+  def _get_info(self):
+    """
+    Description
+    -----------
+    This method retrieves /mgmt/shared/appsvcs/info, sending If-None-Match with the last ETag so an
+    unchanged response is served as a 304 from a copy of the cached response
+
+    Parameters
+    ----------
+    None
+
+    Return: the info dict on success, False on failure
+    """
+    headers = {}
+    if self._info_etag:
+      headers['If-None-Match'] = self._info_etag
+    try:
+      response = self._icr_get('/mgmt/shared/appsvcs/info', headers)
+    except requests.exceptions.RequestException as e:
+      self.error = str(e)
+      return False
+    if response.status_code == 304 and self._info_cached is not None:
+      self._debug("/mgmt/shared/appsvcs/info not modified, using cached response")
+      return copy.deepcopy(self._info_cached)
+    if response.status_code == 404:
+      # AS3 is not installed, or is still loading, which is not an error
+      return False
+    if response.status_code >= 400:
+      self.error = response.text
+      return False
+    try:
+      info = response.json()
+    except ValueError:
+      return False
+    self._info_etag = response.headers.get('ETag')
+    self._info_cached = copy.deepcopy(info)
+    return info
+
+  def _icr_get(self,uri,headers):
+    # WORKAROUND: iCR.get cannot send extra request headers and fails on the empty body of a 304,
+    # so issue the GET on the iCR session directly. This is the only place iCR internals are used.
+    self.bigip._set_auth()
+    return self.bigip.icr_session.get(self.bigip._set_url(uri), headers=headers, timeout=self.bigip.timeout)
 
   def versionToId(self,version):
     # Function to map a version name to an ID
     # eg version = 'v3.16.0' and ID is 22093972
-    releases = self.github('releases')
-    if not releases:
+    release = self._find_release(version)
+    if not release:
       return False
-    else:
-      # Loop through all releases and check if name matches the version name
-      for release in json.loads(releases):
+    return str(release['id'])
+
+  def _find_release(self,version):
+    """
+    Description
+    -----------
+    This method returns the Github release object for a version name. The releases list is cached
+    for RELEASES_CACHE_TTL seconds so repeated lookups do not refetch it.
+
+    Parameters
+    ----------
+    version : string. The release name eg 'v3.16.0'
+
+    Return: the release dict on success, False if it cannot be found
+    """
+    timestamp, releases = self._releases_cache
+    if releases is None or time.monotonic() - timestamp >= RELEASES_CACHE_TTL:
+      response = self.github('releases',as_json=True)
+      if not response:
+        return False
+      releases = {}
+      for release in response:
         self._debug("Release version:" + release['name'] + ', ID:' + str(release['id']))
-        if str(release['name']) == str(version):
-          return str(release['id'])
-      # If the name is not found, return False
-      return False
+        # Keep the first, newest, release with a given name as the linear scan used to
+        releases.setdefault(str(release['name']), release)
+      self._releases_cache = (time.monotonic(), releases)
+    # If the name is not found, return False
+    return releases.get(str(version), False)
 
-  def retrieveVersion(self,**kwargs):
+  def retrieveVersion(self,*,release=False,release_obj=False):
     # Retrieve the release version of AS3 RPM and SHA256 digest from GitHub
     # Also outputs the release notes
     #
     # input = release => Release ID to be retrieved, NOT name eg 123456. Defaults to latest version
+    # input = release_obj => An already retrieved release dict, skips the Github lookup
     #
-    # Allow download of a specific version
-    release = kwargs.pop('release', False)
+    if release_obj:
+      return self._process_release(release_obj)
     #
-    # If a specific version has not been requested then retrieve the latest version ID and run recursively    
+    # releases/latest returns the full release object so there is no need to look it up again by ID
     if not release:
-      # Retrieve the release ID for the latest version
-      r = self.github('releases/latest')
-      if not r:
-        # Cannot retrieve the latest version
-        return False
-      else:
-        # Retrieve the latest version and run recursively
-        latest = json.loads(r)['id']
-        return self.retrieveVersion(release=latest)
+      uri = 'releases/latest'
     else:
-      # Retrieve a specific release ID
-
       uri = 'releases/' + str(release)
-      response = self.github(uri)
-      if not response:
-        return False
+    response = self.github(uri,as_json=True)
+    if not response:
+      return False
+    return self._process_release(response)
+
+  def _process_release(self,release):
+    """
+    Description
+    -----------
+    This method writes out the release notes for a Github release and downloads its RPM asset
+
+    Parameters
+    ----------
+    release : dict. The release object as returned by the Github API
+
+    Return: the filename of the downloaded RPM on success, False on failure
+    """
+    self._debug ("Release version:" + release['name'] + ', ID:' + str(release['id']))
+    # Output the release notes below while the RPM downloads
+    notes = _IO_POOL.submit(_write_notes, release['name'], release.get('body') or '')
 
-      release = json.loads(response)
-      self._debug ("Release version:" + release['name'] + ', ID:' + str(release['id']))
-      # Output the release notes below
-      body = release['body'].encode('utf-8','replace')
-      open ('release-notes-' + release['name'] + '.txt','wb').write(body)
-
-      # Loop through the assets for this release
-      for file in release['assets']:
-        if file['name'].endswith('rpm'):
-          self._debug("Downloading file name:" + str(file['name'] + ', Asset ID:' + str(file['id'])))
-          response = self.github('releases/assets/' + str(file['id']),stream=True)
-          if not response:
-            self._debug("Download failed:")
-            return False
+    # Pick the RPM asset, preferring noarch packages then by name so the choice is deterministic
+    rpms = sorted([ a for a in release['assets'] if a['name'].endswith('.rpm') ], key=lambda a: ('noarch' not in a['name'], a['name']))
+    filename = False
+    if not rpms:
+      self.error = "No RPM asset found for release " + release['name']
+    else:
+      file = rpms[0]
+      digest = self._release_digest(release,file)
+      self._debug("Expected SHA256 digest for " + file['name'] + ": " + str(digest))
+      if digest and os.path.exists(file['name']) and _sha256_file(file['name']) == digest:
+        self._debug("File " + file['name'] + " already downloaded with matching digest")
+        filename = file['name']
+      else:
+        self._debug("Downloading file name:" + str(file['name'] + ', Asset ID:' + str(file['id'])))
+        response = self.github('releases/assets/' + str(file['id']),stream=True)
+        if not response:
+          self._debug("Download failed:")
+        else:
+          try:
+            self._download(response,file['name'])
+          except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            # Reading response.raw bypasses requests so urllib3 errors, eg a dropped connection, arrive unwrapped
+            self.error = "Download of " + file['name'] + " failed: " + str(e)
           else:
-            with open (file['name'],'wb') as fd:
-              for chunk in response:
-                fd.write(chunk)
-            return file['name']
+            if digest and _sha256_file(file['name']) != digest:
+              self.error = "SHA256 digest of " + file['name'] + " does not match " + digest
+              os.unlink(file['name'])
+            else:
+              filename = file['name']
+    # Make sure the release notes are written, raising any error from the write
+    notes.result()
+    return filename
+
+  def _release_digest(self,release,asset):
+    """
+    Description
+    -----------
+    This method finds the published SHA256 digest of a release asset. It checks the digest field Github
+    reports for the asset, then a <name>.sha256 asset, then a digest next to the asset name in the release notes.
+
+    Parameters
+    ----------
+    release : dict. The release object as returned by the Github API
+    asset : dict. The asset object within the release
+
+    Return: the lowercase hex digest, or False if none is published
+    """
+    if str(asset.get('digest','')).startswith('sha256:'):
+      return asset['digest'][len('sha256:'):].lower()
+    for file in release['assets']:
+      if file['name'] == asset['name'] + '.sha256':
+        # This lookup is optional so a failure must not leave an error behind
+        error = self.error
+        response = self.github('releases/assets/' + str(file['id']),stream=True)
+        self.error = error
+        if response:
+          match = _SHA256_RE.search(response.text)
+          response.close()
+          if match:
+            return match.group(1).lower()
+    for line in (release.get('body') or '').splitlines():
+      if asset['name'] in line:
+        match = _SHA256_RE.search(line)
+        if match:
+          return match.group(1).lower()
+    return False
+
+  def _download(self,response,filename):
+    """
+    Description
+    -----------
+    This method saves a streamed asset download to filename. Large assets served with Accept-Ranges are
+    fetched as concurrent byte ranges from the redirected URL, otherwise the stream is copied in large blocks.
+    The data is written to filename.part and only renamed to filename once complete, so an existing
+    filename is always a whole download.
+
+    Parameters
+    ----------
+    response : requests.Response. The streamed response returned by self.github(...,stream=True)
+    filename : string. The local file to write
+
+    Return: none
+    """
+    part = filename + '.part'
+    try:
+      self._download_to(response,part)
+      os.replace(part, filename)
+    except BaseException:
+      response.close()
+      if os.path.exists(part):
+        os.unlink(part)
+      raise
+
+  def _download_to(self,response,filename):
+    # Write the streamed response to filename, using parallel byte ranges for large assets
+    size = int(response.headers.get('Content-Length', 0))
+    if size > PARALLEL_MIN_SIZE and response.headers.get('Accept-Ranges') == 'bytes':
+      # Size the file up front so each range can be written into its own slice
+      response.close()
+      with open(filename,'wb') as fd:
+        fd.truncate(size)
+      step = -(-size // PARALLEL_CHUNKS)
+      ranges = [ (start, min(start + step, size) - 1) for start in range(0, size, step) ]
+      self._debug("Downloading " + str(size) + " bytes in " + str(len(ranges)) + " ranges")
+      with ThreadPoolExecutor(max_workers=PARALLEL_CHUNKS) as pool:
+        results = list(pool.map(lambda r: self._download_range(response.url, filename, r[0], r[1]), ranges))
+      if all(results):
+        return
+      # The server ignored the Range header so fall back to a single stream
+      self._debug("Ranged download not supported, downloading as a single stream")
+      response = self._gh.get(response.url, headers={ 'Accept': 'application/octet-stream' }, stream=True, timeout=10)
+      if response.status_code != 200:
+        response.close()
+        raise requests.exceptions.HTTPError("Download of " + filename + " returned response code " + str(response.status_code), response=response)
+    # Let urllib3 handle any content encoding and copy in large blocks
+    response.raw.decode_content = True
+    with open(filename,'wb') as fd:
+      shutil.copyfileobj(response.raw, fd, 1024*1024)
+    response.close()
+
+  def _download_range(self,url,filename,start,end):
+    # Download bytes start-end of url into the same offset of filename. Returns False if the server does not
+    # return exactly that range, eg it ignored the Range header and returned the whole file
+    headers = { 'Accept': 'application/octet-stream', 'Range': 'bytes=' + str(start) + '-' + str(end) }
+    with self._gh.get(url, headers=headers, stream=True, timeout=10) as response:
+      if response.status_code != 206:
+        return False
+      if not response.headers.get('Content-Range','').startswith('bytes ' + str(start) + '-' + str(end) + '/'):
+        self._debug("Unexpected Content-Range " + str(response.headers.get('Content-Range')) + " for bytes " + str(start) + "-" + str(end))
+        return False
+      with open(filename,'rb+') as fd:
+        fd.seek(start)
+        shutil.copyfileobj(response.raw, fd, 1024*1024)
+    return True